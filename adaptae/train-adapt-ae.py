@@ -20,7 +20,7 @@ Usage:
                              [--save-results] [--phased] 
                              [--result-strategy {batch-size,seq-prop,
                              all-hyper,latent,all}] [--num-images NUM_IMAGES] 
-                             --task {reconstruction,anomaly-detection}
+                             [--compile] [--bf16] --task {reconstruction,anomaly-detection}
 
     Training a AdaptAE model
 
@@ -58,6 +58,12 @@ Usage:
       --num-images NUM_IMAGES
                             The number of images to generate. Defaults to 5 if not provided
 
+      --compile             Whether to compile the sequential phase with torch.compile
+
+  --bf16                Whether to run the hidden layer matmul in BF16 on CUDA devices that support it
+
+      --bf16                Whether to run the hidden layer matmul in BF16 on CUDA devices that support it
+
       --task {reconstruction,anomaly-detection}
                             The task to perform (either 'reconstruction' or 'anomaly-detection')
 
@@ -68,17 +74,26 @@ from models.adaptae import AdaptAE
 from util.util import *
 from util.data import *
 import torch
-from torch.utils.data import random_split
+from torch.utils.data import Subset
 import logging
 import time
 import warnings
 import psutil
 import argparse
+import os
+import resource
+import sys
 
 # Constants
 DEFAULT_BATCH_SIZE = 10
 DEFAULT_SEQ_PROP = 0.97
 DEFAULT_NUM_IMAGES = 5
+NUM_WORKERS = min(4, os.cpu_count() or 1)
+PREDICT_CHUNK_SIZE = 4096
+SEQ_LOADER_ROWS = 1024
+NUM_LOSS_STEPS = 100
+# ru_maxrss is reported in bytes on macOS and in KiB elsewhere
+MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
 result_data = []
 
 """
@@ -87,14 +102,29 @@ Initialize the AdaptAE model
 :type input_nodes: int
 :param hidden_nodes: The number of hidden nodes
 :type hidden_nodes: int
+:param compile_model: Boolean indicating if we should compile the sequential phase
+:type compile_model: bool
+:param use_bf16: Boolean indicating if we should run the hidden layer matmul in BF16
+:type use_bf16: bool
 :return: The initialized AdaptAE model
 :rtype: AdaptAE
 """
-def adaptae_init(input_nodes, hidden_nodes):
+def adaptae_init(input_nodes, hidden_nodes, compile_model, use_bf16):
     logging.info(f"Initializing AdaptAE model...")
     activation_func = 'tanh'
+    model = AdaptAE(activation_func, input_nodes, hidden_nodes, device, use_bf16).to(device)
+
+    if use_bf16 and not (device == "cuda" and torch.cuda.is_bf16_supported()):
+        logging.warning("BF16 is not supported on this device, running the hidden layer in FP32")
+
+    if compile_model:
+        # Fuse the small kernels of each sequential update, and on CUDA
+        # replay them as graphs to cut the kernel launch overhead
+        compile_mode = "reduce-overhead" if device == "cuda" else "default"
+        model.seq_phase = torch.compile(model.seq_phase, mode=compile_mode)
+
     logging.info(f"Initializing AdaptAE model complete.\n")
-    return AdaptAE(activation_func, input_nodes, hidden_nodes, device).to(device)
+    return model
 
 """
 Load and split the data
@@ -129,32 +159,49 @@ def load_and_split_data(dataset, mode, batch_size, seq_prop, task):
     # Load the data
     input_nodes, hidden_nodes, train_data, test_data = load_data(dataset)
 
-    train_size = int(0.8 * len(train_data))  
-    valid_size = len(train_data) - train_size  
+    # Shuffle the indices once and slice both splits from the same
+    # permutation, so each subset indexes the dataset directly
+    perm = torch.randperm(len(train_data)).tolist()
 
     # Split the training data into training and validation data
     # so it trains on the same quantity of data as the autoencoder
     # model. The validation set is not used in training.
-    train_data, _ = random_split(train_data, [train_size, valid_size])
+    split_size = int(0.8 * len(train_data))
 
     # Split the training data into training and sequential data
     # Based on the sequential training proportion
-    seq_size = int(seq_prop * len(train_data))
-    train_size = len(train_data) - seq_size
-    train_data, seq_data = random_split(train_data, [train_size, seq_size])
+    seq_size = int(seq_prop * split_size)
+    train_size = split_size - seq_size
+    seq_data = Subset(train_data, perm[train_size:split_size])
+    train_data = Subset(train_data, perm[:train_size])
+
+    # Load batches in worker processes into pinned memory so host to
+    # device copies can overlap with computation
+    loader_args = {
+        "num_workers": NUM_WORKERS,
+        "pin_memory": device == "cuda",
+    }
 
     # Create the data loaders
-    train_loader = torch.utils.data.DataLoader(train_data, batch_size = train_size, shuffle = True)
-    seq_loader = torch.utils.data.DataLoader(seq_data, batch_size = batch_size, shuffle = True)
+    train_loader = torch.utils.data.DataLoader(train_data, batch_size = train_size, shuffle = True, **loader_args)
+    # Load the sequential data in large batches holding a whole number of
+    # training batches, which train_sequential then slices up
+    seq_loader_size = max(1, SEQ_LOADER_ROWS // batch_size) * batch_size
+    seq_loader = torch.utils.data.DataLoader(seq_data, batch_size = seq_loader_size, shuffle = True, **loader_args)
+
+    # Only the test loader is iterated more than once (again for the latent
+    # plot), so it is the only one that keeps its workers alive
+    loader_args["persistent_workers"] = True
 
     if task == "reconstruction":
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size, shuffle = False)
+        test_loader = torch.utils.data.DataLoader(test_data, batch_size, shuffle = False, **loader_args)
     else:
         # Create a noisy test loader for anomaly detection
         test_loader = torch.utils.data.DataLoader(
             NoisyLoader(test_data),
             batch_size=batch_size,
-            shuffle=False
+            shuffle=False,
+            **loader_args
         )
 
     logging.info(f"Loading and preparing data complete.")
@@ -175,7 +222,7 @@ def train_init(model, train_loader, phased):
 
     for (data, _) in train_loader:
         # Reshape the data to fit the model
-        data = data.reshape(-1, model.input_shape[0]).float().to(device)
+        data = data.reshape(-1, model.input_shape[0]).float().to(device, non_blocking=True)
         logging.info(f"Initial training on {len(data)} samples...")
 
         # Don't reset the peak memory if we're monitoring total memory
@@ -226,51 +273,66 @@ Train the AdaptAE model sequentially on the sequential training data
 :type model: AdaptAE
 :param seq_loader: The sequential training loader
 :type seq_loader: torch.utils.data.DataLoader
+:param batch_size: The batch size to train on
+:type batch_size: int
 :param mode: The mode of sequential training, either "sample" or "batch"
 :type mode: str
 :param phased: Boolean indicating if we're monitoring phased training
 :type phased: bool
 """
-def train_sequential(model, seq_loader, mode, phased):
-    logging.info(f"Sequential training on {len(seq_loader)} batches in {mode} mode...")
+def train_sequential(model, seq_loader, batch_size, mode, phased):
+    num_batches = (len(seq_loader.dataset) + batch_size - 1) // batch_size
+    logging.info(f"Sequential training on {num_batches} batches in {mode} mode...")
 
-    # Metrics for each iteration
-    total_loss = 0
+    # Metrics for each iteration, with the loss accumulated on the
+    # device to avoid a host sync every step
+    total_loss = torch.zeros((), device=device)
     peak_memory = 0
-    process = None
 
     # Don't reset the peak memory if we're monitoring total memory
-    if phased:
-        if device == "cuda":
-            torch.cuda.reset_peak_memory_stats()
-        else:
-            process = psutil.Process()
-            peak_memory = process.memory_info().rss
+    if phased and device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
 
     start_time = time.time()
-    for (data, _) in seq_loader:
-        # Reshape the data to fit the model
-        data = data.reshape(-1, model.input_shape[0]).float().to(device)
 
-        model.seq_phase(data, mode)
+    # The loss is only tracked for monitoring, so evaluate it on roughly
+    # NUM_LOSS_STEPS evenly spaced steps rather than on every step
+    log_every = max(1, num_batches // NUM_LOSS_STEPS)
+    num_logged = 0
+    step = 0
 
-        # Set peak memory to the max of the current memory and
-        # the peak memory if using CPU
-        if phased:
-            if device == "cpu":
-                current_memory = process.memory_info().rss
-                peak_memory = max(peak_memory, current_memory)
+    # Slice the training batches out of each large loaded batch, so the
+    # per-sample loop avoids the DataLoader without holding the whole
+    # sequential set in memory. The slices share the loader's pinned memory
+    for (seq_data, _) in seq_loader:
+        seq_data = seq_data.reshape(-1, model.input_shape[0]).float()
 
-        pred = model.predict(data)
-        loss, _ = evaluate(data, pred)
-        total_loss += loss.item()
+        for data in seq_data.split(batch_size):
+            data = data.to(device, non_blocking=True)
+
+            model.seq_phase(data, mode)
 
+            if step % log_every == 0:
+                pred = model.predict_cached()
+                loss, _ = evaluate(data, pred)
+                total_loss.add_(loss.detach())
+                num_logged += 1
+            step += 1
+
+    # Reading the loss back waits for any queued device work to finish
+    avg_loss = total_loss.item() / num_logged
     end_time = time.time()
 
+    # The kernel keeps track of the peak resident set size, so a single
+    # reading after the loop still sees any peak inside it without polling
+    # the process every step. The peak covers the whole process, which
+    # includes loading the data before the sequential phase
     if phased:
         if device == "cuda":
             peak_memory = torch.cuda.max_memory_allocated() / (1024 ** 2)
-
+        else:
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * MAXRSS_BYTES
+            peak_memory = peak_rss / (1024 ** 2)
 
     # Print results
     print_header("Sequential Training Benchmarks")
@@ -278,15 +340,15 @@ def train_sequential(model, seq_loader, mode, phased):
         print(f"Peak memory allocated during training: {peak_memory:.2f} MB")
     training_time = end_time - start_time
     print(f"Time taken: {training_time:.2f} seconds.")
-    print(f"Average loss per batch: {total_loss / len(seq_loader):.5f}")
+    print(f"Average loss per batch: {avg_loss:.5f}")
 
     # Saving results
     if phased:
         result_data.append(training_time)
         result_data.append(round(peak_memory, 2))
-        result_data.append(float(str(f"{(total_loss / len(seq_loader)):3f}")))
+        result_data.append(float(str(f"{avg_loss:3f}")))
     else:
-        result_data.append(float(str(f"{(total_loss / len(seq_loader)):3f}")))
+        result_data.append(float(str(f"{avg_loss:3f}")))
 
     logging.info(f"Sequential training complete")
 
@@ -298,6 +360,8 @@ Train the model
 :type train_loader: torch.utils.data.DataLoader
 :param seq_loader: The sequential training data loader
 :type seq_loader: torch.utils.data.DataLoader
+:param batch_size: The batch size to train on
+:type batch_size: int
 :param mode: The mode of sequential training, either "sample" or "batch"
 :type mode: str
 :param device: The device to use
@@ -305,7 +369,7 @@ Train the model
 :param phased: Boolean indicating if we're monitoring phased training
 :type phased: bool
 """
-def train_model(model, train_loader, seq_loader, mode, phased):
+def train_model(model, train_loader, seq_loader, batch_size, mode, phased):
     peak_memory = 0
     process = None
 
@@ -320,7 +384,7 @@ def train_model(model, train_loader, seq_loader, mode, phased):
     start_time = time.time()
 
     train_init(model, train_loader, phased)
-    train_sequential(model, seq_loader, mode, phased)
+    train_sequential(model, seq_loader, batch_size, mode, phased)
 
     end_time = time.time()
 
@@ -360,9 +424,7 @@ Test the AdaptAE model on the test data
 def test_model(model, test_loader, dataset, gen_imgs, num_imgs, seq_prop, task):
     logging.info(f"Testing on {len(test_loader.dataset)} batches...")
 
-    losses = []
-    outputs = []
-    saved_img = False
+    sample_losses = []
     batch_size = test_loader.batch_size
 
     result_parent_dir = (
@@ -376,44 +438,36 @@ def test_model(model, test_loader, dataset, gen_imgs, num_imgs, seq_prop, task):
         else f"{result_parent_dir}/{dataset}-{task}-batch-{batch_size}.png"
     )
 
-    for (data, _) in test_loader:
-        # Reshape the data to fit the model
-        data = data.reshape(-1, model.input_shape[0]).float().to(device)
-
-        # Predict and evaluate the model
+    # Prediction does not depend on the batching, so collate the test data
+    # once and predict it in large chunks instead of batch by batch
+    test_data = torch.cat([data for (data, _) in test_loader])
+    test_data = test_data.reshape(-1, model.input_shape[0]).float()
+
+    for chunk in test_data.split(PREDICT_CHUNK_SIZE):
+        chunk = chunk.to(device, non_blocking=True)
+        pred = model.predict(chunk)
+        sample_losses.append(((chunk - pred) ** 2).mean(dim=1).detach())
+
+    # Average the per-sample losses over each test batch, including
+    # a final partial batch
+    sample_losses = torch.cat(sample_losses)
+    num_full = (sample_losses.shape[0] // batch_size) * batch_size
+    losses = sample_losses[:num_full].reshape(-1, batch_size).mean(dim=1)
+    if num_full < sample_losses.shape[0]:
+        losses = torch.cat([losses, sample_losses[num_full:].mean().unsqueeze(0)])
+    losses = losses.tolist()
+
+    if gen_imgs:
+        # Only save the first num_imgs images
+        data = test_data[:num_imgs].to(device)
         pred = model.predict(data)
-        loss, _ = evaluate(data, pred)
-        losses.append(loss.item())
-
-        # If the batch size is less than the number of images we want to generate,
-        # save the outputs so we can use multiple batches to generate the desired
-        # number of images
-        if test_loader.batch_size < num_imgs:
-            outputs.append((data, pred))
-        if gen_imgs:
-            if not saved_img:
-                # Only save the first num_imgs images
-                if test_loader.batch_size < num_imgs:
-                    if len(outputs) > num_imgs:
-                        full_data = torch.cat([data for (data, _) in outputs], dim=0)
-                        full_pred = torch.cat([pred for (_, pred) in outputs], dim=0)
-                        visualize_comparisons(
-                            full_data.cpu().numpy(),
-                            full_pred.cpu().detach().numpy(),
-                            dataset,
-                            num_imgs,
-                            results_file
-                        )
-                        saved_img = True
-                else:
-                    visualize_comparisons(
-                        data.cpu().numpy(),
-                        pred.cpu().detach().numpy(),
-                        dataset,
-                        num_imgs,
-                        results_file
-                    )
-                    saved_img = True
+        visualize_comparisons(
+            data.cpu().numpy(),
+            pred.cpu().detach().numpy(),
+            dataset,
+            num_imgs,
+            results_file
+        )
 
     # Print results
     print_header("Testing Benchmarks")
@@ -461,6 +515,10 @@ Get the arguments from the command line
 :rtype result_strategy: str
 :return num_imgs: The number of images to generate
 :rtype num_imgs: int
+:return compile_model: Boolean indicating if we should compile the sequential phase
+:rtype compile_model: bool
+:return use_bf16: Boolean indicating if we should run the hidden layer matmul in BF16
+:rtype use_bf16: bool
 :return task: The task to test on
 :rtype task: str
 """
@@ -529,6 +587,16 @@ def get_args():
         default=DEFAULT_NUM_IMAGES,
         help="The number of images to generate. Defaults to 5 if not provided"
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Whether to compile the sequential phase with torch.compile"
+    )
+    parser.add_argument(
+        "--bf16",
+        action="store_true",
+        help="Whether to run the hidden layer matmul in BF16 on CUDA devices that support it"
+    )
     parser.add_argument(
         "--task",
         type=str,
@@ -548,6 +616,8 @@ def get_args():
     phased = args.phased
     result_strategy = args.result_strategy
     num_images = args.num_images
+    compile_model = args.compile
+    use_bf16 = args.bf16
     task = args.task
 
     # Assume sample mode if no mode is specified
@@ -586,6 +656,8 @@ def get_args():
         "phased": phased,
         "result_strategy": result_strategy,
         "num_images": num_images,
+        "compile": compile_model,
+        "bf16": use_bf16,
         "task": task
     }
 
@@ -616,11 +688,12 @@ def main():
         config["seq_prop"], 
         config["task"]
     )
-    model = adaptae_init(input_nodes, hidden_nodes)
+    model = adaptae_init(input_nodes, hidden_nodes, config["compile"], config["bf16"])
     train_model(
         model, 
         train_loader, 
         seq_loader, 
+        config["batch_size"],
         config["mode"], 
         config["phased"]
     )
@@ -63,6 +63,7 @@ from models.autoencoder import Autoencoder
 from util.util import *
 from util.data import *
 import torch
+import torch.nn as nn
 from torch.utils.data import random_split
 import logging
 import time
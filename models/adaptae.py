@@ -16,33 +16,115 @@ import torch
 from util.util import assert_cond
 from torch import nn
 import torch.nn.functional as F
-from torch.linalg import pinv
+
+"""
+Calculate the tanh hidden layer output, compiled with TorchScript
+:param x: The input data
+:type x: torch.Tensor
+:param alpha: The input weights
+:type alpha: torch.Tensor
+:param bias: The hidden layer bias
+:type bias: torch.Tensor
+:return: The hidden layer output in FP32
+:rtype: torch.Tensor
+"""
+@torch.jit.script
+def tanh_hidden(x: torch.Tensor, alpha: torch.Tensor, bias: torch.Tensor) -> torch.Tensor:
+    return torch.tanh_(torch.addmm(bias, x, alpha).float())
+
+"""
+Predict the output of a network with a tanh hidden layer, compiled with TorchScript
+:param x: The input data
+:type x: torch.Tensor
+:param alpha: The input weights
+:type alpha: torch.Tensor
+:param bias: The hidden layer bias
+:type bias: torch.Tensor
+:param beta: The output weights
+:type beta: torch.Tensor
+:return: The predicted output
+:rtype: torch.Tensor
+"""
+@torch.jit.script
+def tanh_predict(x: torch.Tensor, alpha: torch.Tensor, bias: torch.Tensor, beta: torch.Tensor) -> torch.Tensor:
+    return torch.matmul(tanh_hidden(x, alpha, bias), beta)
 
 class AdaptAE(nn.Module):
 
-    def __init__(self, activation_func, n_input_nodes, n_hidden_nodes, device):
+    def __init__(self, activation_func, n_input_nodes, n_hidden_nodes, device, use_bf16=False):
         super().__init__()
 
         self.__name = "AdaptAE"
         self.__n_input_nodes = n_input_nodes
         self.__n_hidden_nodes = n_hidden_nodes
+        self.__ridge = 0.001
 
         if activation_func == "tanh":
-            self.__activation_func = torch.tanh
+            # In-place variant, applied to the fresh output of addmm
+            self.__activation_func = torch.tanh_
+            # TorchScript versions for predict and encoded_representation.
+            # torch.compile cannot trace into TorchScript, so the training
+            # phases keep using the eager activation
+            self.__hidden_func = tanh_hidden
+            self.__predict_func = tanh_predict
         else:
             raise ValueError("Activation function not supported")
 
-        self.__alpha = nn.Parameter(torch.randn(n_input_nodes, n_hidden_nodes))
+        # The weights are solved in closed form, so autograd is never needed
+        self.__alpha = nn.Parameter(torch.empty(n_input_nodes, n_hidden_nodes, device=device), requires_grad=False)
         nn.init.orthogonal_(self.__alpha)
 
-        bias = torch.randn(n_hidden_nodes).to(device)
+        bias = torch.randn(n_hidden_nodes, device=device)
         bias = F.normalize(bias, p=2, dim=0)  # Normalize the bias vector to have unit norm
-        self.__bias = nn.Parameter(bias)
+        self.__bias = nn.Parameter(bias, requires_grad=False)
 
-        self.__p = torch.zeros(n_hidden_nodes, n_hidden_nodes).to(device)
-        self.__beta = torch.zeros(n_hidden_nodes, n_input_nodes).to(device)
+        # BF16 is only used when requested on a CUDA device that supports
+        # it, since older GPUs lose precision without any speedup. The BF16
+        # copies of alpha and bias are created on first use
+        self.__use_bf16 = use_bf16 and device == "cuda" and torch.cuda.is_bf16_supported()
+        self.__alpha_bf16 = None
+        self.__bias_bf16 = None
+
+        self.__p = torch.zeros(n_hidden_nodes, n_hidden_nodes, device=device)
+        self.__beta = torch.zeros(n_hidden_nodes, n_input_nodes, device=device)
+        self.__last_H = None
         self.__device = device
 
+        # Scratch buffers reused by every sample mode update
+        self.__PH_buf = torch.empty(n_hidden_nodes, device=device)
+        self.__PH_scaled_buf = torch.empty(n_hidden_nodes, device=device)
+        self.__denom_buf = torch.empty((), device=device)
+        self.__THB_buf = torch.empty(n_input_nodes, device=device)
+
+    """
+    Return the operands of the hidden layer matmul, using BF16 if enabled
+    :param x: The input data
+    :type x: torch.Tensor
+    :return: The input data, alpha and bias
+    :rtype: tuple
+    """
+    def __hidden_args(self, x):
+        if self.__use_bf16:
+            # Run the GEMM in BF16 on the tensor cores, but keep the hidden layer
+            # output in FP32 for the P and beta updates
+            if self.__alpha_bf16 is None:
+                self.__alpha_bf16 = self.__alpha.bfloat16()
+                self.__bias_bf16 = self.__bias.bfloat16()
+            return x.bfloat16(), self.__alpha_bf16, self.__bias_bf16
+        return x, self.__alpha, self.__bias
+
+    """
+    Calculate the hidden layer output of the network, fusing the bias
+    addition into the matmul
+    :param x: The input data
+    :type x: torch.Tensor
+    :return: The hidden layer output
+    :rtype: torch.Tensor
+    """
+    def __hidden(self, x):
+        x, alpha, bias = self.__hidden_args(x)
+        return self.__activation_func(torch.addmm(bias, x, alpha).float())
+
     """
     Predict the output of the network based on the input data
     :param test_data: The test data
@@ -50,9 +132,21 @@ class AdaptAE(nn.Module):
     :return: The predicted output
     :rtype: torch.Tensor
     """
+    @torch.no_grad()
     def predict(self, test_data):
-        H = self.__activation_func(torch.matmul(test_data, self.__alpha) + self.__bias)
-        return torch.matmul(H, self.__beta)
+        x, alpha, bias = self.__hidden_args(test_data)
+        return self.__predict_func(x, alpha, bias, self.__beta)
+
+    """
+    Predict the output of the network for the data last passed to seq_phase,
+    reusing its hidden layer output instead of recomputing it
+    :return: The predicted output
+    :rtype: torch.Tensor
+    """
+    @torch.no_grad()
+    def predict_cached(self):
+        assert_cond(self.__last_H is not None, "No hidden layer output cached from the sequential phase")
+        return torch.matmul(self.__last_H, self.__beta)
 
     """
     Initialize the network based on the input data
@@ -61,17 +155,23 @@ class AdaptAE(nn.Module):
     :return: The network after initialization phase
     :rtype: torch.Tensor
     """
+    @torch.no_grad()
     def init_phase(self, data):
         assert_cond(data.shape[1] == self.__n_input_nodes, "Input data shape does not match the input nodes")
-        H = self.__activation_func(torch.matmul(data, self.__alpha) + self.__bias)
+        H = self.__hidden(data)
         assert_cond(H.shape[1] == self.__n_hidden_nodes, "Hidden layer shape does not match the hidden nodes")
         assert_cond(H.shape[0] == data.shape[0], "Hidden layer shape does not match number of samples")
 
-        self.__p = pinv(torch.matmul(H.T, H))
-        pH_T = torch.matmul(self.__p, H.T)
+        # Solve the ridge-regularised normal equations with a Cholesky
+        # factorisation rather than an SVD-based pseudoinverse
+        H_TH = torch.matmul(H.T, H)
+        H_TH.diagonal().add_(self.__ridge)
+        L = torch.linalg.cholesky(H_TH)
+        del H_TH
+        self.__beta = torch.cholesky_solve(torch.matmul(H.T, data), L)
         del H
-        self.__beta = torch.matmul(pH_T, data)
-        del pH_T
+        self.__p = torch.cholesky_inverse(L)
+        del L
         return self.__beta
 
     """
@@ -83,20 +183,20 @@ class AdaptAE(nn.Module):
     :return: The network after sequential training
     :rtype: torch.Tensor
     """
+    @torch.no_grad()
     def seq_phase(self, data, mode):
         # Assert that the hidden layer shape matches the hidden nodes
-        H = self.__activation_func(torch.matmul(data, self.__alpha) + self.__bias)
+        H = self.__hidden(data)
+        self.__last_H = H
 
         if mode == "batch":
             assert_cond(H.shape[1] == self.__n_hidden_nodes, "Hidden layer shape does not match the hidden nodes")
             assert_cond(data.shape[1] == self.__n_input_nodes, "Input data shape does not match the input nodes")
-            batch_size = data.shape[0]
-            self.calc_p_batch(batch_size, H)
+            self.calc_p_batch(H)
             self.calc_beta_batch(data, H)
         elif mode == "sample":
             assert_cond(H.shape[1] == self.__n_hidden_nodes, "Hidden layer shape does not match the hidden nodes")
-            self.calc_p_sample(H.T)
-            self.calc_beta_sample(data, H.T)
+            self.calc_p_beta_sample(data.squeeze(0), H.squeeze(0))
         else:
             raise ValueError("Mode not supported")
 
@@ -104,18 +204,21 @@ class AdaptAE(nn.Module):
 
     """
     Calculate the p of the network based on batch of input data
-    :param batch_size: The size of the batch
-    :type batch_size: int
     :param H: The hidden layer output matrix
     :type H: torch.Tensor
     """
-    def calc_p_batch(self, batch_size, H):
+    @torch.no_grad()
+    def calc_p_batch(self, H):
         PH_T = torch.matmul(self.__p, H.T)
-        I = torch.eye(batch_size).to(self.__device)
-        HPH_T_Inv = pinv(torch.matmul(H, torch.matmul(self.__p, H.T)) + I)
-        del I
-        HP = torch.matmul(H, self.__p)
-        self.__p -= torch.matmul(torch.matmul(PH_T, HPH_T_Inv), HP)
+        HPH_T = torch.matmul(H, PH_T)
+        HPH_T.diagonal().add_(1)
+        # With H P H^T + I = L L^T, the update P H^T (H P H^T + I)^-1 H P is
+        # Y^T Y for Y = L^-1 H P, which only needs P H^T and keeps P
+        # symmetric in float32 instead of drifting until it is no longer
+        # positive definite
+        L = torch.linalg.cholesky(HPH_T)
+        Y = torch.linalg.solve_triangular(L, PH_T.T, upper=False)
+        self.__p.addmm_(Y.T, Y, alpha=-1)
 
     """
     Calculate the beta of the network based on batch of input data
@@ -124,37 +227,30 @@ class AdaptAE(nn.Module):
     :param H: The hidden layer output matrix
     :type H: torch.Tensor
     """
+    @torch.no_grad()
     def calc_beta_batch(self, batch, H):
-        THB = batch - torch.matmul(H, self.__beta)
-        self.__beta += torch.matmul(torch.matmul(self.__p, H.T), THB)
-
-    """
-    Calculate the p of the network based on sample of input data
-    :param H: The hidden layer output matrix
-    :type H: torch.Tensor
-    """
-    def calc_p_sample(self, H):
-        with torch.no_grad():
-            PH = torch.matmul(self.__p, H)
-            PHH_T = torch.matmul(PH, H.T)
-            del PH
-            PHH_TP = torch.matmul(PHH_T, self.__p)
-            del PHH_T
-            H_TPH = torch.matmul(H.T, torch.matmul(self.__p, H))
-            self.__p -= torch.div(PHH_TP, 1 + H_TPH)
+        THB = torch.addmm(batch, H, self.__beta, alpha=-1)
+        self.__beta.addmm_(torch.matmul(self.__p, H.T), THB)
 
     """
-    Calculate the beta of the network based on sample of input data
+    Calculate the p and beta of the network based on a sample of input data,
+    sharing a single P h product between both updates
     :param sample: The sample of input data
     :type sample: torch.Tensor
-    :param H: The hidden layer output matrix
-    :type H: torch.Tensor
+    :param h: The hidden layer output vector
+    :type h: torch.Tensor
     """
-    def calc_beta_sample(self, sample, H):
-        with torch.no_grad():
-            THB = sample - torch.matmul(H.T, self.__beta)
-            PH_T = torch.matmul(self.__p, H)
-            self.__beta += torch.matmul(PH_T, THB)
+    @torch.no_grad()
+    def calc_p_beta_sample(self, sample, h):
+        # Sherman-Morrison rank-1 update: P -= (P h h^T P) / (1 + h^T P h).
+        # The updated P h is P h / (1 + h^T P h), which also drives beta
+        PH = torch.mv(self.__p, h, out=self.__PH_buf)
+        denom = torch.dot(h, PH, out=self.__denom_buf).add_(1)
+        PH_scaled = torch.div(PH, denom, out=self.__PH_scaled_buf)
+        THB = torch.mv(self.__beta.T, h, out=self.__THB_buf)
+        torch.sub(sample, THB, out=THB)
+        self.__p.addr_(PH_scaled, PH, alpha=-1)
+        self.__beta.addr_(PH_scaled, THB)
 
     """
     Return the encoded representation of the input
@@ -163,8 +259,10 @@ class AdaptAE(nn.Module):
     :return: The encoded representation of the input
     :rtype: torch.Tensor
     """
+    @torch.no_grad()
     def encoded_representation(self, x):
-        return self.__activation_func(torch.matmul(x, self.__alpha) + self.__bias)
+        x, alpha, bias = self.__hidden_args(x)
+        return self.__hidden_func(x, alpha, bias)
 
     """
     Return the input shape of the network
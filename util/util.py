@@ -14,13 +14,67 @@ License:
 """
 
 import logging
+import matplotlib
+matplotlib.use('Agg') # Plots are only saved to files, so skip the GUI backend
 import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
 import numpy as np
 import seaborn as sns
-from torch import nn
+import torch
+from torch.nn import functional as F
+from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 from sklearn.metrics import confusion_matrix
+import atexit
 import csv
+import os
+import sys
+
+# FIt-SNE is optional, falling back to scikit-learn's t-SNE when missing
+try:
+    from fitsne import FItSNE
+except ImportError:
+    FItSNE = None
+
+# Display names of the datasets and tasks
+DATASET_NAMES = {
+    "mnist": "MNIST",
+    "fashion-mnist": "Fashion-MNIST",
+    "cifar10": "CIFAR-10",
+    "cifar100": "CIFAR-100",
+    "super-tiny-imagenet": "Super Tiny ImageNet",
+    "tiny-imagenet": "Tiny ImageNet"
+}
+
+TASK_NAMES = {
+    "reconstruction": "Reconstruction",
+    "anomaly-detection": "Anomaly Detection",
+}
+
+# Datasets with 28x28 greyscale and 32x32 colour images
+MNIST_DATASETS = frozenset(["mnist", "fashion-mnist", "mnist-corrupted"])
+CIFAR_DATASETS = frozenset(["cifar10", "cifar100", "super-tiny-imagenet"])
+
+TSNE_PCA_DIMS = 50
+TSNE_MAX_POINTS = 20000
+
+"""
+Reshape a batch of flattened images into displayable images
+:param imgs: The flattened images
+:type imgs: numpy.ndarray
+:param dataset: The dataset used
+:type dataset: str
+:return: The images in (N, H, W) or (N, H, W, C) layout
+:rtype: numpy.ndarray
+"""
+def reshape_images(imgs, dataset):
+    imgs = np.asarray(imgs)
+    if dataset in MNIST_DATASETS:
+        return imgs.reshape(-1, 28, 28)
+    elif dataset in CIFAR_DATASETS:
+        return imgs.reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+    else:
+        return imgs.reshape(-1, 3, 64, 64).transpose(0, 2, 3, 1)
 
 """
 Visualize the original and reconstructed images
@@ -35,32 +89,24 @@ Visualize the original and reconstructed images
 """
 def visualize_comparisons(originals, reconstructions, dataset, num_imgs, results_file):
     logging.info(f"Generating {num_imgs} images...")
-    plt.figure(figsize=(20, 4))
-    for i in range(num_imgs): # Display original images
-        ax = plt.subplot(2, num_imgs, i + 1)
-        if dataset in ["mnist", "fashion-mnist", "mnist-corrupted"]:
-            plt.imshow(originals[i].reshape(28, 28))
-        elif dataset in ["cifar10", "cifar100", "super-tiny-imagenet"]:
-            plt.imshow(originals[i].reshape(3, 32, 32).transpose(1, 2, 0))
-        else:
-            plt.imshow(originals[i].reshape(3, 64, 64).transpose(1, 2, 0))
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-
-        # Display reconstructed images
-        ax = plt.subplot(2, num_imgs, i + 1 + num_imgs)
-        if dataset in ["mnist", "fashion-mnist", "mnist-corrupted"]:
-            plt.imshow(reconstructions[i].reshape(28, 28))
-        elif dataset in ["cifar10", "cifar100", "super-tiny-imagenet"]:
-            plt.imshow(reconstructions[i].reshape(3, 32, 32).transpose(1, 2, 0))
-        else:
-            plt.imshow(reconstructions[i].reshape(3, 64, 64).transpose(1, 2, 0))
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
+
+    # Reshape all the images up front rather than one at a time
+    originals = reshape_images(originals[:num_imgs], dataset)
+    reconstructions = reshape_images(reconstructions[:num_imgs], dataset)
+
+    # Create the whole grid of axes at once and draw straight onto it
+    fig, axes = plt.subplots(2, num_imgs, figsize=(20, 4), squeeze=False)
+    for ax in axes.flat:
+        ax.set_axis_off()
+
+    for i in range(num_imgs):
+        axes[0, i].imshow(originals[i]) # Display original images
+        axes[1, i].imshow(reconstructions[i]) # Display reconstructed images
 
     # Save the images
     logging.info(f"Saving images to output file...")
-    plt.savefig(results_file)
+    fig.savefig(results_file, bbox_inches='tight', dpi=80)
+    plt.close(fig)
 
 """
 Evaluate the network based on the test data and the predicted data
@@ -73,8 +119,7 @@ Evaluate the network based on the test data and the predicted data
 :rtype accuracy: torch.Tensor
 """
 def evaluate(test_data, pred_data):
-    criterion = nn.MSELoss()
-    loss = criterion(test_data, pred_data)
+    loss = F.mse_loss(test_data, pred_data)
     accuracy = 0
     return loss, accuracy
 
@@ -86,39 +131,45 @@ Plot the latent space representation of the model
 :type loader: torch.utils.data.DataLoader
 :param results_file: The file to save the results to
 :type results_file: str
+:param max_points: The maximum number of points to embed with t-SNE
+:type max_points: int
 """
-def plot_latent_representation(model, loader, dataset, task, results_file):
-    points = []
-    labels = []
-
-    task_names = {
-        "reconstruction": "Reconstruction",
-        "anomaly-detection": "Anomaly Detection",
-    }
-
-    dataset_names = {
-        "mnist": "MNIST",
-        "fashion-mnist": "Fashion-MNIST",
-        "cifar10": "CIFAR-10",
-        "cifar100": "CIFAR-100",
-        "super-tiny-imagenet": "Super Tiny ImageNet",
-        "tiny-imagenet": "Tiny ImageNet"
-    }
-
-    for (img, label) in loader:
-        img = img.reshape(-1, model.input_shape[0]).to(model.device)
-        proj = model.encoded_representation(img)
-        points.append(proj.detach().cpu().numpy())
-        labels.append(label.detach().cpu().numpy())
-
-    points = np.concatenate(points, axis=0)
-    labels = np.concatenate(labels, axis=0)
-
-    tsne = TSNE(n_components=2, random_state=0)
-    tsne_results = tsne.fit_transform(points)
-
-    plt.figure(figsize=(12, 10))
-    num_classes = np.unique(labels).size
+def plot_latent_representation(model, loader, dataset, task, results_file, max_points=TSNE_MAX_POINTS):
+    # Preallocate the embeddings and labels and fill them batch by batch,
+    # avoiding the second full-size copy made by concatenating at the end.
+    # The embeddings stay on the device until every batch is encoded, so
+    # they are copied back in one transfer rather than one per batch
+    num_points = len(loader.dataset)
+    points = torch.empty((num_points, model.hidden_shape[0]), dtype=torch.float32, device=model.device)
+    labels = np.empty(num_points, dtype=np.int64)
+    offset = 0
+
+    # No gradients are needed to embed the data
+    with torch.inference_mode():
+        for (img, label) in loader:
+            img = img.reshape(-1, model.input_shape[0]).to(model.device, non_blocking=True)
+            proj = model.encoded_representation(img)
+            batch_size = proj.shape[0]
+            points[offset:offset + batch_size].copy_(proj)
+            labels[offset:offset + batch_size] = label.numpy()
+            offset += batch_size
+
+    points = points.cpu().numpy()
+
+    # t-SNE scales super-linearly, so embed a fixed random subsample of
+    # large datasets instead of every point
+    if num_points > max_points:
+        idx = np.random.default_rng(0).choice(num_points, max_points, replace=False)
+        points = points[idx]
+        labels = labels[idx]
+
+    tsne_results = calc_tsne(points)
+
+    fig, ax = plt.subplots(figsize=(12, 10))
+
+    # Map the labels to contiguous class indices in a single pass
+    classes, class_idx = np.unique(labels, return_inverse=True)
+    num_classes = classes.size
 
     # Check for 'dataset' attribute to determine how to access class names
     if hasattr(loader.dataset, 'dataset') and hasattr(loader.dataset.dataset, 'classes'):
@@ -126,17 +177,50 @@ def plot_latent_representation(model, loader, dataset, task, results_file):
     elif hasattr(loader.dataset, 'classes'):
         class_names = loader.dataset.classes
     else:
-        class_names = [str(i) for i in range(num_classes)]
+        class_names = {label: str(label) for label in classes}
+
+    # Draw every point as a single collection coloured by class, and
+    # build the legend from the colormap instead of one artist per class
+    cmap = plt.get_cmap('tab20', num_classes)
+    ax.scatter(
+        tsne_results[:, 0],
+        tsne_results[:, 1],
+        c=class_idx,
+        cmap=cmap,
+        vmin=0,
+        vmax=num_classes - 1,
+        alpha=0.5,
+        rasterized=True
+    )
+    handles = [mpatches.Patch(color=cmap(i), label=class_names[label]) for (i, label) in enumerate(classes)]
 
-    for i in range(num_classes):
-        indices = labels == i
-        plt.scatter(tsne_results[indices, 0], tsne_results[indices, 1], label=class_names[i], alpha=0.5)
+    ax.set_title(f"{model.name} Latent Space Representation of the {DATASET_NAMES[dataset]} Dataset for {TASK_NAMES[task]}")
+    ax.set_xlabel("t-SNE Dimension 1")
+    ax.set_ylabel("t-SNE Dimension 2")
+    ax.legend(handles=handles)
+    fig.savefig(results_file, bbox_inches='tight', dpi=72)
+    plt.close(fig)
 
-    plt.title(f"{model.name} Latent Space Representation of the {dataset_names[dataset]} Dataset for {task_names[task]}")
-    plt.xlabel("t-SNE Dimension 1")
-    plt.ylabel("t-SNE Dimension 2")
-    plt.legend()
-    plt.savefig(results_file)
+"""
+Embed points into two dimensions with t-SNE, using the FFT-accelerated
+FIt-SNE when it is installed. Wide points are first reduced with PCA
+:param points: The points to embed
+:type points: numpy.ndarray
+:return: The two dimensional embedding
+:rtype: numpy.ndarray
+"""
+def calc_tsne(points):
+    if points.shape[1] > TSNE_PCA_DIMS:
+        pca = PCA(n_components=TSNE_PCA_DIMS, svd_solver='randomized', random_state=0)
+        points = pca.fit_transform(points)
+
+    if FItSNE is not None:
+        # FIt-SNE reads the raw buffer, so it needs C-contiguous float64 data
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        return FItSNE(points, no_dims=2, perplexity=30, rand_seed=0, nthreads=os.cpu_count())
+
+    tsne = TSNE(n_components=2, random_state=0)
+    return tsne.fit_transform(points)
 
 """
 Plot the loss distribution of the model
@@ -150,45 +234,42 @@ Plot the loss distribution of the model
 :type results_file: str
 """
 def plot_loss_distribution(model_name, losses, dataset, batch_size, loss_file, confusion_file):
-    dataset_names = {
-        "mnist": "MNIST",
-        "fashion-mnist": "Fashion-MNIST",
-        "cifar10": "CIFAR-10",
-        "cifar100": "CIFAR-100",
-        "super-tiny-imagenet": "Super Tiny ImageNet",
-        "tiny-imagenet": "Tiny ImageNet"
-    }
-
     split_point = 1500 // batch_size
 
-    # Splitting the losses into anomalies and normal
-    anomaly_losses = np.array(losses[:split_point])
-    normal_losses = np.array(losses[split_point:])
+    # Convert the losses once, then split them into anomalies and normal
+    losses = np.fromiter(losses, dtype=np.float64, count=len(losses))
+    anomaly_losses = losses[:split_point]
+    normal_losses = losses[split_point:]
 
     mean_normal_losses = np.mean(normal_losses)
     std_normal_losses = np.std(normal_losses)
     std_dev_threshold = mean_normal_losses + (3 * std_normal_losses)
 
-    fig, _ = plt.subplots(figsize=(10, 6))
-    plt.title(f"{model_name} Loss Distribution of Partially Noisy {dataset_names[dataset]} Test Dataset")
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.set_title(f"{model_name} Loss Distribution of Partially Noisy {DATASET_NAMES[dataset]} Test Dataset")
 
-    # Plotting both distributions
-    sns.distplot(anomaly_losses, bins=50, kde=False, color="red", label="Anomalies")
-    sns.distplot(normal_losses, bins=50, kde=False, color="blue", label="Normal Data")
+    # Plotting both distributions as histograms directly, rather than
+    # through the deprecated seaborn distplot
+    for (dist_losses, color, label) in [
+        (anomaly_losses, "red", "Anomalies"),
+        (normal_losses, "blue", "Normal Data")
+    ]:
+        counts, edges = np.histogram(dist_losses, bins=50)
+        ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge", color=color, alpha=0.4, label=label)
 
-    plt.axvline(x=std_dev_threshold, color='green', linestyle='--', label=f'3-std threshold')
+    ax.axvline(x=std_dev_threshold, color='green', linestyle='--', label=f'3-std threshold')
 
-    plt.xlabel("Test Loss")
-    plt.ylabel("Number of Batches")
-    plt.legend()
-    plt.savefig(loss_file)
+    ax.set_xlabel("Test Loss")
+    ax.set_ylabel("Number of Batches")
+    ax.legend()
+    fig.savefig(loss_file)
 
     plt.close(fig)
     plot_confusion_matrix(
         model_name,
         losses,
         std_dev_threshold,
-        dataset_names,
+        DATASET_NAMES,
         dataset,
         split_point,
         confusion_file
@@ -221,29 +302,48 @@ def plot_confusion_matrix(model_name, losses, threshold, dataset_names, dataset,
     # Calculate confusion matrix
     conf_matrix = confusion_matrix(true_labels, predictions)
 
-    plt.subplots(figsize=(8, 6))
+    fig, ax = plt.subplots(figsize=(8, 6))
     sns.heatmap(conf_matrix, annot=True, fmt='d', cmap='Blues',
                 xticklabels=['Normal', 'Anomaly'],
-                yticklabels=['Normal', 'Anomaly'])
+                yticklabels=['Normal', 'Anomaly'],
+                ax=ax)
+
+    ax.set_ylabel('Actual')
+    ax.set_xlabel('Predicted')
+    ax.set_title(f"Confusion Matrix for {model_name} on {dataset_names[dataset]}")
+    fig.savefig(confusion_file)
+    plt.close(fig)
 
-    plt.ylabel('Actual')
-    plt.xlabel('Predicted')
-    plt.title(f"Confusion Matrix for {model_name} on {dataset_names[dataset]}")
-    plt.savefig(confusion_file)
+# Result files kept open across calls, mapped to their file and CSV writer
+result_files = {}
 
 """
-Save the results to a CSV file
-:param dataset: The dataset used
-:type dataset: str
-:param phased: Boolean indicating whether the model was monitored in a phased manner
-:type phased: bool
-:param result_strategy: The result strategy used
-:type result_strategy: str
+Save the results to a CSV file, keeping the file open and buffered so
+repeated calls do not reopen it for every row
+:param result_data: The row of results to save
+:type result_data: list
+:param results_file: The file to save the results to
+:type results_file: str
 """
 def save_result_data(result_data, results_file):
-    with open (results_file, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(result_data)
+    if results_file not in result_files:
+        # Open with O_APPEND so every flushed block lands atomically at the
+        # end of the file, even when several processes share it
+        fd = os.open(results_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        f = os.fdopen(fd, 'w', newline='', buffering=1 << 16)
+        result_files[results_file] = (f, csv.writer(f))
+    _, writer = result_files[results_file]
+    writer.writerow(result_data)
+
+"""
+Close all open result files, flushing any buffered rows
+"""
+def close_result_files():
+    for (f, _) in result_files.values():
+        f.close()
+    result_files.clear()
+
+atexit.register(close_result_files)
 
 """
 Print the header of a stage
@@ -251,8 +351,7 @@ Print the header of a stage
 :type header: str
 """
 def print_header(header):
-    result_str = "\n" + header + "\n" + "=" * len(header)
-    print(result_str)
+    sys.stdout.write(f"\n{header}\n{'=' * len(header)}\n")
 
 """
 Exit the program with an error message of the correct usage
@@ -274,8 +373,8 @@ Assert a condition and log the error if the condition is not met
 :type msg: str
 """
 def assert_cond(condition, msg):
-    try:
-        assert condition, msg
-    except AssertionError as e:
-        logging.error(e)
-        raise e
+    # Like assert, the check is compiled out when running with python -O
+    if __debug__:
+        if not condition:
+            logging.error(msg)
+            raise AssertionError(msg)